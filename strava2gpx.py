@@ -1,102 +1,268 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import csv
-import fileinput
-import gzip
+import functools
+import io
+import json
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
 import zipfile
-from typing import Dict, IO, List, Optional
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
+try:
+    # python-isal's SIMD-accelerated drop-in replacement for the gzip module
+    from isal import igzip as gzip
+except ImportError:
+    import gzip  # type: ignore
 
-def matches_filter_types(activity: Dict, filter_types: Optional[List]) -> bool:
-    if not filter_types:
-        return True
-    activity_type = activity["type"].lower()
-    for filter_type in filter_types:
-        if filter_type.lower() == activity_type:
-            return True
-    return False
 
+def matches_filter_types(activity: Dict, filter_types: Optional[Set[str]]) -> bool:
+    # filter_types holds lower case types, see main()
+    return filter_types is None or activity["type"].lower() in filter_types
 
-def matches_filter_years(activity: Dict, filter_years: Optional[List]) -> bool:
-    if not filter_years:
-        return True
-    activity_year = activity["date"][0:4]
-    if activity_year in filter_years:
-        return True
-    return False
 
+def matches_filter_years(activity: Dict, filter_years: Optional[Set[str]]) -> bool:
+    return filter_years is None or activity["date"][0:4] in filter_years
 
-GPSBABEL_FILE_TYPE = {"fit": "garmin_fit", "tcx": "gtrnctr"}
-
-
-def gpsbabel_convert(input_file_path: str, output_file_path: str, file_type: str):
-    subprocess.run(
-        [
-            "gpsbabel",
-            "-i",
-            GPSBABEL_FILE_TYPE[file_type],
-            "-f",
-            input_file_path,
-            "-o",
-            "gpx",
-            "-F",
-            output_file_path,
-        ]
-    )
-
-
-def strip_whitespaces_from_file(input_file_path: str):
-    with fileinput.FileInput(files=(input_file_path,), inplace=True) as fp:
-        for line in fp:
-            print(line.strip())
 
+# Empty if gpsbabel is not in $PATH, see main()
+GPSBABEL = shutil.which("gpsbabel") or ""
 
-def gunzip(gzip_file_name: str, target_file_obj: IO):
-    with gzip.open(gzip_file_name, "rb") as gzip_file:
-        shutil.copyfileobj(gzip_file, target_file_obj)
-        target_file_obj.flush()
-
-
-def zip_extract(zip_file: zipfile.ZipFile, file_name: str, target_file_obj: IO):
-    with zip_file.open(file_name) as fp:
-        shutil.copyfileobj(fp, target_file_obj)
-        target_file_obj.flush()
-
+GPSBABEL_FILE_TYPE = {"fit": "garmin_fit", "tcx": "gtrnctr"}
 
-def convert_activity(activity_file_name: str, target_gpx_file_name: str):
-    if (
-        activity_file_name.endswith(".fit.gz")
-        or activity_file_name.endswith(".tcx.gz")
-        or activity_file_name.endswith(".gpx.gz")
-    ):
-        suffix = activity_file_name[-7:-3]
-        with tempfile.NamedTemporaryFile(suffix=suffix) as gunzipped_file:
-            gunzip(activity_file_name, gunzipped_file)
-            gunzipped_file.flush()
-            convert_activity(gunzipped_file.name, target_gpx_file_name)
 
-    elif activity_file_name.endswith(".fit"):
-        gpsbabel_convert(activity_file_name, target_gpx_file_name, "fit")
+# gpsbabel keeps everything it has read in memory and writes all of it to each
+# output file, so this filter is applied after every conversion of a batch.
+GPSBABEL_RESET_FILTER = "nuketypes,waypoints,tracks,routes"
+
+# Upper bound for the number of conversions in one gpsbabel run. This also
+# limits the work that is repeated when a batch fails, see gpsbabel_run_batch().
+GPSBABEL_BATCH_SIZE = 100
+
+GpsbabelJob = Tuple[str, str, str]
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def gpsbabel_quote(arg: str) -> str:
+    # gpsbabel splits batch files at spaces, except within double quotes
+    return '"' + arg.replace('"', '""') + '"'
+
+
+def gpsbabel_run(file_type: str, jobs: List[GpsbabelJob], work_dir: str) -> bool:
+    # Pass the arguments in a batch file, which, unlike the command line, has no
+    # length limit
+    batch_file, batch_file_name = create_temp_file(".txt", work_dir)
+    with batch_file:
+        batch_file.write(f"-i {GPSBABEL_FILE_TYPE[file_type]}\n".encode())
+        for input_file_path, output_file_path, _ in jobs:
+            args = ["-f", input_file_path, "-o", "gpx", "-F", output_file_path]
+            args += ["-x", GPSBABEL_RESET_FILTER]
+            line = " ".join(gpsbabel_quote(arg) for arg in args)
+            batch_file.write(f"{line}\n".encode("utf-8"))
+    # With close_fds=False and an absolute executable path, subprocess can use
+    # posix_spawn instead of fork + closing all file descriptors. This is safe,
+    # as Python creates all file descriptors non-inheritable (PEP 446).
+    try:
+        result = subprocess.run(
+            [GPSBABEL, "-b", batch_file_name],
+            close_fds=False,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+        )
+    finally:
+        os.remove(batch_file_name)
+    return result.returncode == 0
+
+
+def gpsbabel_run_batch(file_type: str, jobs: List[GpsbabelJob], work_dir: str):
+    # gpsbabel aborts at the first broken input file, after having written the
+    # outputs of all jobs before it. Remove stale outputs first, so that after a
+    # failure the first missing output marks the broken input; then skip it and
+    # continue with the rest of the batch.
+    for _, output_file_path, _ in jobs:
+        if os.path.exists(output_file_path):
+            os.remove(output_file_path)
+    remaining_jobs = jobs
+    while remaining_jobs and not gpsbabel_run(file_type, remaining_jobs, work_dir):
+        broken_index = next(
+            (
+                index
+                for index, (_, output_file_path, _) in enumerate(remaining_jobs)
+                if not os.path.exists(output_file_path)
+            ),
+            len(remaining_jobs),
+        )
+        remaining_jobs = remaining_jobs[broken_index + 1 :]
+
+    # Remove the prepared inputs (gunzipped, stripped or extracted copies) as
+    # soon as the batch is done. Together with the limit on batches in flight in
+    # main(), this keeps the work directory from growing with the export size.
+    # These are exactly the inputs created in work_dir, never the user's files.
+    for input_file_path, _, _ in jobs:
+        if os.path.dirname(input_file_path) == work_dir:
+            os.remove(input_file_path)
+
+
+def create_temp_file(suffix: str, work_dir: str) -> Tuple[IO[bytes], str]:
+    # Cheaper than NamedTemporaryFile; the file is removed once its gpsbabel
+    # batch is done, or else along with work_dir.
+    fd, file_name = tempfile.mkstemp(suffix=suffix, dir=work_dir)
+    return os.fdopen(fd, "wb"), file_name
+
+
+def strip_whitespaces(tcx_file: IO[bytes], work_dir: str) -> str:
+    # As gpsbabel does not support tcx files with leading or trailing spaces,
+    # write a copy with stripped lines
+    stripped_file, stripped_file_name = create_temp_file(".tcx", work_dir)
+    with stripped_file:
+        stripped_file.writelines(line.strip() + b"\n" for line in tcx_file)
+    return stripped_file_name
+
+
+# A large buffer keeps the number of read/write calls per activity low.
+COPY_BUFFER_SIZE = 1 << 20
+
+# Zip members up to this size are read and inflated in one go, see
+# open_zip_member().
+ZIP_READ_SIZE_LIMIT = 64 << 20
+
+
+def copy_file(source_file_name: str, target_file_name: str):
+    # copy_file_range lets the kernel copy the data (or, on reflink capable file
+    # systems, share it) without passing it through user space
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source_file_name, "rb") as source_file, open(
+                target_file_name, "wb"
+            ) as target_file:
+                size = os.fstat(source_file.fileno()).st_size
+                copied = 0
+                while True:
+                    count = os.copy_file_range(
+                        source_file.fileno(), target_file.fileno(), 1 << 30
+                    )
+                    if not count:
+                        break
+                    copied += count
+            # Some file systems (e.g. procfs, some FUSE or network mounts) report
+            # 0 bytes copied for non-empty files; fall back to a regular copy then
+            if copied >= size:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(source_file_name, target_file_name)
+
+
+def open_zip_member(zip_file: zipfile.ZipFile, file_name: str) -> IO[bytes]:
+    # Activity files are small, so inflate them in one go and work in memory;
+    # only unusually large members are streamed
+    if zip_file.getinfo(file_name).file_size <= ZIP_READ_SIZE_LIMIT:
+        return io.BytesIO(zip_file.read(file_name))
+    return zip_file.open(file_name)
+
+
+def activity_file_suffix(activity_file_name: str) -> str:
+    # ".fit", ".tcx", ... or, for gzipped files, ".fit.gz", ".tcx.gz", ...
+    parts = os.path.basename(activity_file_name).lower().rsplit(".", 2)
+    if len(parts) == 3 and parts[2] == "gz":
+        return f".{parts[1]}.gz"
+    return f".{parts[-1]}" if len(parts) > 1 else ""
+
+
+# The converters below get the (gunzipped) activity data as a binary stream,
+# convert it straight into target_gpx_file_name or prepare an input file in
+# work_dir, and return the gpsbabel job for the latter.
+
+
+def convert_fit(
+    activity_file: IO[bytes], target_gpx_file_name: str, work_dir: str
+) -> Optional[GpsbabelJob]:
+    if isinstance(activity_file, io.BufferedReader):
+        # A plain .fit file, which gpsbabel can read as it is
+        return (activity_file.name, target_gpx_file_name, "fit")
+    fit_file, fit_file_name = create_temp_file(".fit", work_dir)
+    with fit_file:
+        shutil.copyfileobj(activity_file, fit_file, COPY_BUFFER_SIZE)
+    return (fit_file_name, target_gpx_file_name, "fit")
+
+
+def convert_tcx(
+    activity_file: IO[bytes], target_gpx_file_name: str, work_dir: str
+) -> Optional[GpsbabelJob]:
+    return (strip_whitespaces(activity_file, work_dir), target_gpx_file_name, "tcx")
+
+
+def convert_gpx(
+    activity_file: IO[bytes], target_gpx_file_name: str, work_dir: str
+) -> Optional[GpsbabelJob]:
+    if isinstance(activity_file, io.BufferedReader):
+        # A plain .gpx file, which the kernel may copy on its own
+        copy_file(activity_file.name, target_gpx_file_name)
+    else:
+        with open(target_gpx_file_name, "wb") as gpx_file:
+            shutil.copyfileobj(activity_file, gpx_file, COPY_BUFFER_SIZE)
+    return None
+
+
+ACTIVITY_CONVERTERS: Dict[
+    str, Callable[[IO[bytes], str, str], Optional[GpsbabelJob]]
+] = {
+    ".fit": convert_fit,
+    ".tcx": convert_tcx,
+    ".gpx": convert_gpx,
+}
+
+
+def convert_activity(
+    zip_file: Optional[zipfile.ZipFile],
+    activity_file_name: str,
+    target_gpx_file_name: str,
+    work_dir: str,
+) -> Optional[GpsbabelJob]:
+    suffix = activity_file_suffix(activity_file_name)
+    gzipped = suffix.endswith(".gz")
+    converter = ACTIVITY_CONVERTERS.get(suffix[:-3] if gzipped else suffix)
+    if not converter:
+        print(f"Unrecognized/unsupported file format: {activity_file_name}\n")
+        return None
 
-    elif activity_file_name.endswith(".tcx"):
-        with tempfile.NamedTemporaryFile() as tcx_file:
-            # As gpsbabel does not support tcx files with trailing spaces, remove them
-            shutil.copyfile(activity_file_name, str(tcx_file))
-            tcx_file.flush()
-            strip_whitespaces_from_file(tcx_file.name)
-            gpsbabel_convert(tcx_file.name, target_gpx_file_name, "tcx")
+    if zip_file:
+        activity_file = open_zip_member(zip_file, activity_file_name)
+    else:
+        activity_file = open(activity_file_name, "rb")
+    with activity_file:
+        if gzipped:
+            with gzip.open(activity_file, "rb") as gzip_file:
+                return converter(gzip_file, target_gpx_file_name, work_dir)
+        return converter(activity_file, target_gpx_file_name, work_dir)
 
-    elif activity_file_name.endswith(".gpx"):
-        shutil.copyfile(activity_file_name, target_gpx_file_name)
 
-    else:
-        print(f"Unrecognized/unsupported file format: {activity_file_name}\n")
+def scan_directory(directory: str) -> Dict[str, str]:
+    # Maps the names of the files in directory to their paths. A single scandir
+    # call replaces the stat calls of checking (or opening) each file on its
+    # own, which is notably faster on network file systems.
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.path for entry in entries if entry.is_file()}
 
 
 def print_usage_error(args_parser: argparse.ArgumentParser, message: str):
@@ -105,37 +271,146 @@ def print_usage_error(args_parser: argparse.ArgumentParser, message: str):
     sys.exit(2)
 
 
-def get_activities(
+def open_activities_csv(
     zip_file: Optional[zipfile.ZipFile], csv_file_name: str
-) -> List[Dict]:
+) -> IO[str]:
     if zip_file:
-        with tempfile.NamedTemporaryFile(suffix=".csv") as unzipped_file:
-            zip_extract(zip_file, csv_file_name, unzipped_file)
-            return get_activities(None, unzipped_file.name)
-    with open(csv_file_name) as csv_file:
-        activities = list(csv.DictReader(csv_file))
-        if len(activities) == 0:
-            return []
-
-        keys = list(activities[0].keys())
-        if len(keys) != 10 and len(keys) != 11:
-            raise Exception(
-                f"Unexpected header items in activities CSV file (expeciting 10 or 11 items): {list(keys)}"
+        return io.TextIOWrapper(zip_file.open(csv_file_name))
+    return open(csv_file_name)
+
+
+def read_activities_header(reader: Iterator[List[str]]) -> Optional[List[str]]:
+    header = next(reader, None)
+    if header is not None and len(header) != 10 and len(header) != 11:
+        raise Exception(
+            f"Unexpected header items in activities CSV file (expeciting 10 or 11 items): {header}"
+        )
+    return header
+
+
+def read_activities(csv_file: IO[str]) -> List[Dict]:
+    reader = csv.reader(csv_file)
+    header = read_activities_header(reader)
+    if header is None:
+        return []
+
+    id_index = 0
+    date_index = 1
+    type_index = 3
+    filename_index = len(header) - 1
+    # Rows may be shorter than the header; a missing file name is left empty, so
+    # the activity is skipped when converting
+    return [
+        {
+            "id": row[id_index],
+            "type": row[type_index],
+            "date": row[date_index],
+            "filename": row[filename_index] if len(row) > filename_index else "",
+        }
+        for row in reader
+        if len(row) > type_index
+    ]
+
+
+# Stored with the cached activities; bump whenever read_activities() changes
+# what it returns, so older caches are ignored.
+ACTIVITIES_CACHE_VERSION = 1
+
+
+def activities_cache_file_name(source_file_name: str) -> str:
+    directory, file_name = os.path.split(source_file_name)
+    return os.path.join(directory, f".{file_name}.cache.json")
+
+
+def load_activities_cache(cache_file_name: str, mtime: int) -> Optional[List[Dict]]:
+    try:
+        with open(cache_file_name) as cache_file:
+            cache = json.load(cache_file)
+        if cache["version"] == ACTIVITIES_CACHE_VERSION and cache["mtime"] == mtime:
+            return cache["activities"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def save_activities_cache(cache_file_name: str, mtime: int, activities: List[Dict]):
+    try:
+        with open(cache_file_name, "w") as cache_file:
+            json.dump(
+                {
+                    "version": ACTIVITIES_CACHE_VERSION,
+                    "mtime": mtime,
+                    "activities": activities,
+                },
+                cache_file,
             )
+    except OSError:
+        # e.g. a read-only export directory; the cache is optional
+        pass
 
-        id_field = keys[0]
-        date_field = keys[1]
-        type_field = keys[3]
-        filename_field = keys[-1]
-        return [
-            {
-                "id": a[id_field],
-                "type": a[type_field],
-                "date": a[date_field],
-                "filename": a[filename_field],
-            }
-            for a in activities
-        ]
+
+def activities_cache_location(
+    zip_file: Optional[zipfile.ZipFile], csv_file_name: str
+) -> Tuple[str, int]:
+    # The parsed activities are cached next to the export's activities CSV file
+    # (or zip file), and reused as long as that file is not modified.
+    source_file_name = (
+        zip_file.filename if zip_file and zip_file.filename else csv_file_name
+    )
+    return (
+        activities_cache_file_name(source_file_name),
+        os.stat(source_file_name).st_mtime_ns,
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def get_activities(
+    zip_file: Optional[zipfile.ZipFile], csv_file_name: str
+) -> List[Dict]:
+    cache_file_name, mtime = activities_cache_location(zip_file, csv_file_name)
+    activities = load_activities_cache(cache_file_name, mtime)
+    if activities is not None:
+        return activities
+
+    with open_activities_csv(zip_file, csv_file_name) as csv_file:
+        activities = read_activities(csv_file)
+    save_activities_cache(cache_file_name, mtime, activities)
+    return activities
+
+
+def get_activity_types(
+    zip_file: Optional[zipfile.ZipFile], csv_file_name: str
+) -> Set[str]:
+    # Reuse the cached activities if possible; otherwise only the type column is
+    # needed, so don't build the full activities
+    activities = load_activities_cache(
+        *activities_cache_location(zip_file, csv_file_name)
+    )
+    if activities is not None:
+        return {activity["type"] for activity in activities}
+
+    with open_activities_csv(zip_file, csv_file_name) as csv_file:
+        reader = csv.reader(csv_file)
+        read_activities_header(reader)
+        type_index = 3
+        return {row[type_index] for row in reader if len(row) > type_index}
+
+
+def prefetch(
+    executor: concurrent.futures.Executor,
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    depth: int,
+) -> Iterator[R]:
+    # Like executor.map(fn, items), but runs at most depth calls ahead of the
+    # consumer
+    futures: Deque[concurrent.futures.Future] = collections.deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= depth:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
 
 
 def main():
@@ -204,16 +479,7 @@ def main():
                 "error: you cannot use --output or --filter-type together with --list-types\n",
             )
         print(f"Activity types found in {args.strava_export}:")
-        for activity_type in sorted(
-            list(
-                set(
-                    [
-                        activity["type"]
-                        for activity in get_activities(zip_file, activities_csv)
-                    ]
-                )
-            )
-        ):
+        for activity_type in sorted(get_activity_types(zip_file, activities_csv)):
             print(f"- {activity_type}")
     else:
         if not args.output_dir:
@@ -221,46 +487,136 @@ def main():
                 args_parser,
                 "error: either --output or --list-types must be specified\n",
             )
+        if not GPSBABEL:
+            print_usage_error(args_parser, "error: gpsbabel not found in $PATH\n")
         os.makedirs(args.output_dir, exist_ok=True)
 
-        for activity in get_activities(zip_file, activities_csv):
-            activity_file_name = activity["filename"]
+        filter_types = {t.lower() for t in args.filter_types or []} or None
+        filter_years = set(args.filter_years or []) or None
 
-            if not activity_file_name:
-                continue
+        with tempfile.TemporaryDirectory() as work_dir:
+            tasks = []
+            # Activity files by name, per directory, or None for a directory
+            # that cannot be read; see scan_directory()
+            directory_files: Dict[str, Optional[Dict[str, str]]] = {}
+            zip_file_names = set(zip_file.namelist()) if zip_file else set()
+            for activity in get_activities(zip_file, activities_csv):
+                activity_file_name = activity["filename"]
 
-            if not zip_file:
-                activity_file_name = os.path.join(
-                    args.strava_export, activity_file_name
-                )
+                if not activity_file_name:
+                    continue
 
-            if not matches_filter_years(activity, args.filter_years):
-                if args.verbose:
-                    print(
-                        f'Skipping {activity_file_name}, year={activity["date"][0:4]}.'
+                if not zip_file:
+                    activity_file_name = os.path.join(
+                        args.strava_export, activity_file_name
                     )
-                continue
 
-            if not matches_filter_types(activity, args.filter_types):
-                if args.verbose:
-                    print(f'Skipping {activity_file_name}, type={activity["type"]}.')
-                continue
+                if not matches_filter_years(activity, filter_years):
+                    if args.verbose:
+                        print(
+                            f'Skipping {activity_file_name}, year={activity["date"][0:4]}.'
+                        )
+                    continue
+
+                if not matches_filter_types(activity, filter_types):
+                    if args.verbose:
+                        print(
+                            f'Skipping {activity_file_name}, type={activity["type"]}.'
+                        )
+                    continue
+
+                gpx_file_name = (
+                    f"{activity['date']}_{activity['type']}_{activity['id']}.gpx"
+                )
+                gpx_file_path = os.path.join(args.output_dir, gpx_file_name)
+
+                if not zip_file:
+                    directory, file_name = os.path.split(activity_file_name)
+                    if directory not in directory_files:
+                        try:
+                            directory_files[directory] = scan_directory(directory)
+                        except OSError as error:
+                            # Report it once, not as a missing file per activity
+                            print(f"Cannot read activity directory: {error}\n")
+                            directory_files[directory] = None
+                    files = directory_files[directory]
+                    if files is None:
+                        continue
+                    if file_name not in files:
+                        print(f"Missing activity file: {activity_file_name}\n")
+                        continue
+                    activity_file_name = files[file_name]
+                elif activity_file_name not in zip_file_names:
+                    print(f"Missing activity file: {activity_file_name}\n")
+                    continue
 
-            gpx_file_name = (
-                f"{activity['date']}_{activity['type']}_{activity['id']}.gpx"
-            )
-            gpx_file_path = os.path.join(args.output_dir, gpx_file_name)
-
-            if args.verbose:
-                print(f"Converting {activity_file_name} to {gpx_file_path}.")
-            if zip_file:
-                with tempfile.NamedTemporaryFile(
-                    suffix=os.path.basename(activity_file_name)
-                ) as unzipped_file:
-                    zip_extract(zip_file, activity_file_name, unzipped_file)
-                    convert_activity(unzipped_file.name, gpx_file_path)
-            else:
-                convert_activity(activity_file_name, gpx_file_path)
+                if args.verbose:
+                    print(f"Converting {activity_file_name} to {gpx_file_path}.")
+                tasks.append((activity_file_name, gpx_file_path))
+
+            # Conversions only prepare the input files (gunzipping, stripping,
+            # ...) and queue them as gpsbabel jobs. The jobs are run in
+            # batched gpsbabel invocations, so its startup cost is not paid
+            # once per activity. Batches are started as soon as they are full,
+            # while the next activities are still being prepared, up to a limit
+            # on the batches in flight.
+            # Threads are sufficient to keep all cores busy, as the work mostly
+            # happens in zlib (which releases the GIL) and gpsbabel.
+            def convert_task(task: Tuple[str, str]) -> Optional[GpsbabelJob]:
+                # A broken activity file (e.g. a truncated .gz) must not abort
+                # the whole run, which would lose the jobs still pending. Like
+                # gpsbabel_run_batch(), don't leave a partial output behind; a
+                # partial input in work_dir is removed along with work_dir.
+                activity_file_name, gpx_file_path = task
+                try:
+                    return convert_activity(
+                        zip_file, activity_file_name, gpx_file_path, work_dir
+                    )
+                except Exception as error:
+                    print(f"Failed to convert {activity_file_name}: {error}\n")
+                    if os.path.exists(gpx_file_path):
+                        os.remove(gpx_file_path)
+                    return None
+
+            max_workers = os.cpu_count() or 1
+            batch_size = max(1, min(GPSBABEL_BATCH_SIZE, -(-len(tasks) // max_workers)))
+            pending_jobs: Dict[str, List[GpsbabelJob]] = {
+                file_type: [] for file_type in GPSBABEL_FILE_TYPE
+            }
+            batches: Deque[concurrent.futures.Future] = collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as executor, concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers
+            ) as gpsbabel_executor:
+
+                def submit_batch(file_type: str):
+                    # Preparing is much faster than gpsbabel, so don't run ahead
+                    # of it: with max_workers batches in flight, wait for the
+                    # oldest one, whose inputs are removed once it is done.
+                    if len(batches) >= max_workers:
+                        batches.popleft().result()
+                    batches.append(
+                        gpsbabel_executor.submit(
+                            gpsbabel_run_batch,
+                            file_type,
+                            pending_jobs[file_type],
+                            work_dir,
+                        )
+                    )
+                    pending_jobs[file_type] = []
+
+                for job in prefetch(executor, convert_task, tasks, max_workers):
+                    if job:
+                        pending_jobs[job[2]].append(job)
+                    for file_type, typed_jobs in pending_jobs.items():
+                        if len(typed_jobs) >= batch_size:
+                            submit_batch(file_type)
+                for file_type, typed_jobs in pending_jobs.items():
+                    if typed_jobs:
+                        submit_batch(file_type)
+                for batch in batches:
+                    batch.result()
 
 
 if __name__ == "__main__":